@@ -1,5 +1,7 @@
 """API 路由定义."""
 
+from typing import Optional
+
 from fastapi import APIRouter
 from fastapi.responses import StreamingResponse
 
@@ -9,9 +11,11 @@ from app.models.schemas import (
     LeaveBalanceResponse,
     LeaveRequest,
     LeaveResponse,
+    UsageReportResponse,
 )
 from app.services.chat_service import chat_stream
 from app.services.oa_client import oa_client
+from app.services.usage_meter import usage_meter
 
 router = APIRouter()
 
@@ -58,3 +62,15 @@ async def query_leave_balance(query: LeaveBalanceQuery):
 async def submit_leave_request(request: LeaveRequest):
     """提交请假申请接口."""
     return await oa_client.submit_leave_request(request)
+
+
+# ==================== 用量统计 ====================
+
+
+@router.get("/api/usage/report", response_model=UsageReportResponse)
+async def usage_report(employee_id: Optional[str] = None):
+    """当日 token 用量报告接口.
+
+    按员工和 skill 调用路径聚合；employee_id 仅过滤员工列表，汇总数据为全公司。
+    """
+    return usage_meter.report(employee_id)
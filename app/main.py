@@ -1,5 +1,8 @@
 """AI 请假助手 - 主应用入口."""
 
+import asyncio
+from contextlib import asynccontextmanager
+
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,11 +13,24 @@ from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
 
 from app.api.routes import router
+from app.services.usage_meter import usage_meter
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """启动用量定期落盘任务，退出时写入最后一次快照."""
+    flush_task = asyncio.create_task(usage_meter.run_periodic_flush())
+    yield
+    flush_task.cancel()
+    # flush 内部已捕获写入失败，不会影响退出流程
+    usage_meter.flush()
+
 
 app = FastAPI(
     title="AI 请假助手",
     description="基于 AI Skills 的智能请假 OA 系统",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -86,3 +86,33 @@ class ChatRequest(BaseModel):
     message: str = Field(..., description="用户消息")
     employee_id: Optional[str] = Field(None, description="员工编号")
     history: list[ChatMessage] = Field(default_factory=list, description="对话历史")
+
+
+class UsageStats(BaseModel):
+    """Token 用量统计."""
+
+    requests: int = Field(0, description="对话轮数")
+    llm_calls: int = Field(0, description="LLM 请求次数")
+    prompt_tokens: int = Field(0, description="输入 token 数")
+    completion_tokens: int = Field(0, description="输出 token 数")
+    total_tokens: int = Field(0, description="总 token 数")
+    estimated_calls: int = Field(0, description="用量为本地估算的 LLM 请求次数")
+
+
+class EmployeeUsage(BaseModel):
+    """单个员工的用量与预算."""
+
+    employee_id: str
+    usage: UsageStats
+    daily_budget: Optional[int] = Field(None, description="每日 token 上限，为空表示不限制")
+    remaining_tokens: Optional[int] = Field(None, description="今日剩余 token 数")
+    over_budget: bool = Field(False, description="是否已超出今日预算")
+
+
+class UsageReportResponse(BaseModel):
+    """Token 用量报告."""
+
+    date: str = Field(..., description="统计日期，格式: YYYY-MM-DD")
+    total: UsageStats = Field(..., description="全公司汇总用量")
+    employees: list[EmployeeUsage]
+    skill_paths: dict[str, UsageStats] = Field(..., description="按 skill 调用路径聚合的全公司用量")
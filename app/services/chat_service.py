@@ -6,6 +6,8 @@ from collections.abc import AsyncGenerator
 
 from openai import AsyncOpenAI
 
+from app.services import trace_recorder
+from app.services.usage_meter import TurnUsage, usage_meter
 from app.skills.leave_skills import LEAVE_SKILLS, execute_skill
 
 SYSTEM_PROMPT = """你是一个智能请假助手，帮助员工查询假期余额和提交请假申请。
@@ -41,6 +43,9 @@ SYSTEM_PROMPT = """你是一个智能请假助手，帮助员工查询假期余
 """
 
 
+BUDGET_EXCEEDED_MESSAGE = "今日对话额度已用完，请明天再试"
+
+
 def _get_client() -> AsyncOpenAI:
     """获取 OpenAI 客户端.
 
@@ -56,6 +61,17 @@ def _get_model() -> str:
     return os.getenv("OPENAI_MODEL", "gpt-4o")
 
 
+def _stream_options() -> dict:
+    """流式请求的 usage 选项.
+
+    部分兼容 OpenAI 接口的服务不支持 stream_options，可通过
+    OPENAI_STREAM_USAGE=false 关闭，此时改用本地估算。
+    """
+    if os.getenv("OPENAI_STREAM_USAGE", "true").lower() in ("0", "false", "no"):
+        return {}
+    return {"stream_options": {"include_usage": True}}
+
+
 def _build_messages(
     user_message: str,
     history: list[dict],
@@ -87,24 +103,58 @@ async def chat_stream(
     """流式对话，支持 skills 调用.
 
     使用 SSE (Server-Sent Events) 格式输出。
+    开启录制（CHAT_TRACE_MODE=record）或处于回放中时，记录本轮的输入和输出。
     """
-    client = _get_client()
-    model = _get_model()
+    trace = trace_recorder.begin_turn(user_message, history, employee_id)
+    if trace is None:
+        async for event in _chat_stream(user_message, history, employee_id):
+            yield event
+        return
+
+    token = trace_recorder.use_trace(trace)
+    try:
+        async for event in _chat_stream(user_message, history, employee_id):
+            trace.events.append(event)
+            yield event
+    finally:
+        trace_recorder.reset_trace(token)
+        trace_recorder.end_turn(trace)
+
+
+async def _chat_stream(
+    user_message: str,
+    history: list[dict] | None,
+    employee_id: str | None,
+) -> AsyncGenerator[str, None]:
+    model = trace_recorder.select_model(usage_meter.select_model, employee_id, _get_model())
+    if model is None:
+        yield f"data: {json.dumps({'type': 'error', 'message': BUDGET_EXCEEDED_MESSAGE}, ensure_ascii=False)}\n\n"
+        yield f"data: {json.dumps({'type': 'done'})}\n\n"
+        return
+
+    # 回放时 LLM 响应来自 trace，无需创建客户端
+    client = None if trace_recorder.is_replaying() else _get_client()
     messages = _build_messages(user_message, history or [], employee_id)
+    turn = TurnUsage(employee_id)
 
     try:
         # 第一次请求（可能触发 tool_call）
-        response = await client.chat.completions.create(
+        usage_meter.reserve(turn, messages, LEAVE_SKILLS)
+        response = await trace_recorder.create_completion(
+            client,
             model=model,
             messages=messages,
             tools=LEAVE_SKILLS,
             stream=True,
+            **_stream_options(),
         )
+        call = turn.start_call(messages, tools=LEAVE_SKILLS)
 
         collected_content = ""
         tool_calls_data: dict[int, dict] = {}
 
         async for chunk in response:
+            call.observe(chunk)
             delta = chunk.choices[0].delta if chunk.choices else None
             if not delta:
                 continue
@@ -152,6 +202,7 @@ async def chat_stream(
             for tc in tool_calls_data.values():
                 func_name = tc["function"]["name"]
                 func_args = tc["function"]["arguments"]
+                turn.skills.append(func_name)
 
                 yield f"data: {json.dumps({'type': 'skill_call', 'skill': func_name, 'arguments': func_args}, ensure_ascii=False)}\n\n"
 
@@ -162,6 +213,7 @@ async def chat_stream(
                         {"error": f"调用 {func_name} 失败: {e!s}"},
                         ensure_ascii=False,
                     )
+                trace_recorder.record_skill_call(func_name, func_args, result)
 
                 yield f"data: {json.dumps({'type': 'skill_result', 'skill': func_name, 'result': result}, ensure_ascii=False)}\n\n"
 
@@ -174,13 +226,20 @@ async def chat_stream(
                 )
 
             # 第二次请求，让模型根据 tool 结果生成最终回复
-            response2 = await client.chat.completions.create(
+            # 并发进行中的对话可能已用完额度，此时改用 fallback 模型（不拒绝）
+            model = trace_recorder.select_model(usage_meter.select_followup_model, turn, model)
+            usage_meter.reserve(turn, messages)
+            response2 = await trace_recorder.create_completion(
+                client,
                 model=model,
                 messages=messages,
                 stream=True,
+                **_stream_options(),
             )
+            call = turn.start_call(messages)
 
             async for chunk in response2:
+                call.observe(chunk)
                 delta = chunk.choices[0].delta if chunk.choices else None
                 if not delta:
                     continue
@@ -189,5 +248,8 @@ async def chat_stream(
 
     except Exception as e:
         yield f"data: {json.dumps({'type': 'error', 'message': f'服务异常: {e!s}'}, ensure_ascii=False)}\n\n"
+    finally:
+        # 客户端中途断开时也要计入已消耗的用量
+        usage_meter.record_turn(turn)
 
     yield f"data: {json.dumps({'type': 'done'})}\n\n"
@@ -12,6 +12,7 @@ from app.models.schemas import (
     LeaveRequest,
     LeaveResponse,
 )
+from app.services.trace_recorder import traced_oa_call
 
 # 模拟员工数据
 _MOCK_EMPLOYEES = {
@@ -71,6 +72,7 @@ class OAClient:
         self.base_url = base_url
         self.api_key = api_key
 
+    @traced_oa_call(LeaveBalanceResponse)
     async def query_leave_balance(
         self, employee_id: str, leave_type: LeaveBalanceType | None = None
     ) -> LeaveBalanceResponse:
@@ -123,6 +125,7 @@ class OAClient:
             balances=balances,
         )
 
+    @traced_oa_call(LeaveResponse)
     async def submit_leave_request(self, request: LeaveRequest) -> LeaveResponse:
         """提交请假申请.
 
@@ -0,0 +1,327 @@
+"""对话录制 - 记录每轮对话的上游交互，供回放做可复现的性能回归测试.
+
+录制模式（CHAT_TRACE_MODE=record）下，每轮对话的输入（含按预算选定的模型）、
+上游 LLM chunk 流（含 chunk 间隔）、skill 调用、OA 响应以及 SSE 输出写入
+CHAT_TRACE_DIR 目录下的 JSON 文件，每轮一个文件。
+
+回放时由 ``app.services.trace_replay`` 设置当前 trace，LLM 响应与模型选择
+均从 trace 中读取，不访问网络；chat_stream、execute_skill 照常执行。
+OAClient 的方法整体被替换为录制的响应，其方法体不会执行。
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import time
+import uuid
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+TRACE_VERSION = 2
+
+_current_trace: ContextVar["TurnTrace | None"] = ContextVar("current_trace", default=None)
+
+# 后台写入 trace 文件的任务，持有引用避免被回收
+_pending_writes: set[asyncio.Task] = set()
+
+
+def _get_trace_mode() -> str:
+    return os.getenv("CHAT_TRACE_MODE", "").lower()
+
+
+def _get_trace_dir() -> str:
+    return os.getenv("CHAT_TRACE_DIR", "traces")
+
+
+def _request_summary(kwargs: dict) -> dict:
+    """LLM 请求摘要，回放时用于检查请求是否与录制一致."""
+    return {
+        "model": kwargs.get("model"),
+        "message_count": len(kwargs.get("messages", [])),
+        "tools": bool(kwargs.get("tools")),
+    }
+
+
+class TurnTrace:
+    """单轮对话的 trace.
+
+    不传 data 时为录制模式，传入已录制的 data 时为回放模式。
+    回放模式下 speed 为加速倍数，0 表示不等待（尽可能快）。
+    """
+
+    def __init__(self, data: dict | None = None, speed: float = 1.0):
+        self.replaying = data is not None
+        self.speed = speed
+        self.data = data or {
+            "version": TRACE_VERSION,
+            "recorded_at": time.time(),
+            "inputs": {},
+            "llm_calls": [],
+            "skill_calls": [],
+            "oa_calls": [],
+            "events": [],
+            "elapsed": 0.0,
+        }
+        # 本次运行产生的 SSE 输出和 skill 调用（回放时用于与录制结果比对）
+        self.events: list[str] = []
+        self.skill_calls: list[dict] = []
+        # 回放时发现的与录制不一致之处
+        self.mismatches: list[str] = []
+        self._model_cursor = 0
+        self._llm_cursor = 0
+        self._oa_cursor = 0
+        self._started = time.perf_counter()
+
+    async def sleep(self, seconds: float) -> None:
+        """回放时按原始或加速后的时长等待."""
+        if self.speed > 0 and seconds > 0:
+            await asyncio.sleep(seconds / self.speed)
+
+    # ==================== 模型选择 ====================
+
+    def select_model(self, select, *args) -> str | None:
+        """执行（或回放）一次模型选择，None 表示因预算拒绝.
+
+        回放时沿用录制时的结果，不受回放进程的预算配置影响。
+        """
+        selections = self.data["inputs"].setdefault("model_selections", [])
+        if not self.replaying:
+            model = select(*args)
+            selections.append(model)
+            return model
+
+        if self._model_cursor >= len(selections):
+            self.mismatches.append("模型选择次数超出录制记录")
+            return select(*args)
+        model = selections[self._model_cursor]
+        self._model_cursor += 1
+        return model
+
+    # ==================== LLM ====================
+
+    async def open_llm_stream(self, client, **kwargs):
+        """发起（或回放）一次流式 completion 请求."""
+        if self.replaying:
+            return await self._replay_llm_stream(kwargs)
+
+        record = {
+            "request": _request_summary(kwargs),
+            "open_latency": 0.0,
+            "chunks": [],
+        }
+        self.data["llm_calls"].append(record)
+        start = time.perf_counter()
+        try:
+            response = await client.chat.completions.create(**kwargs)
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["open_latency"] = time.perf_counter() - start
+        return self._record_llm_stream(record, response)
+
+    async def _record_llm_stream(self, record: dict, response):
+        last = time.perf_counter()
+        try:
+            async for chunk in response:
+                now = time.perf_counter()
+                record["chunks"].append(
+                    {"dt": now - last, "data": chunk.model_dump(mode="json")}
+                )
+                yield chunk
+                # 从下游处理完 chunk 后开始计时，只记录等待上游的时间
+                last = time.perf_counter()
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+
+    async def _replay_llm_stream(self, kwargs: dict):
+        calls = self.data["llm_calls"]
+        if self._llm_cursor >= len(calls):
+            raise RuntimeError("回放失败: LLM 请求次数超出录制记录")
+        record = calls[self._llm_cursor]
+        self._llm_cursor += 1
+
+        request = _request_summary(kwargs)
+        if request != record["request"]:
+            self.mismatches.append(
+                f"第 {self._llm_cursor} 次 LLM 请求不一致: 录制 {record['request']}，回放 {request}"
+            )
+
+        await self.sleep(record["open_latency"])
+        if "error" in record and not record["chunks"]:
+            raise RuntimeError(record["error"])
+        return self._replay_chunks(record)
+
+    async def _replay_chunks(self, record: dict):
+        # 延迟导入：仅回放时需要
+        from openai.types.chat import ChatCompletionChunk
+
+        for item in record["chunks"]:
+            await self.sleep(item["dt"])
+            yield ChatCompletionChunk.model_validate(item["data"])
+        if "error" in record:
+            raise RuntimeError(record["error"])
+
+    # ==================== OA ====================
+
+    async def call_oa(self, method: str, response_model, func, *args, **kwargs):
+        """调用（或回放）一次 OA 接口."""
+        if self.replaying:
+            calls = self.data["oa_calls"]
+            if self._oa_cursor >= len(calls) or calls[self._oa_cursor]["method"] != method:
+                raise RuntimeError(f"回放失败: OA 调用 {method} 与录制记录不一致")
+            record = calls[self._oa_cursor]
+            self._oa_cursor += 1
+            await self.sleep(record["elapsed"])
+            return response_model.model_validate(record["response"])
+
+        start = time.perf_counter()
+        result = await func(*args, **kwargs)
+        self.data["oa_calls"].append(
+            {
+                "method": method,
+                "elapsed": time.perf_counter() - start,
+                "response": result.model_dump(mode="json"),
+            }
+        )
+        return result
+
+    # ==================== 落盘 ====================
+
+    def serialize(self) -> str:
+        """汇总录制结果并序列化为 JSON."""
+        self.data["events"] = self.events
+        self.data["skill_calls"] = self.skill_calls
+        self.data["elapsed"] = time.perf_counter() - self._started
+        return json.dumps(self.data, ensure_ascii=False)
+
+
+def _write_trace(content: str) -> None:
+    """将序列化后的 trace 写入 trace 目录."""
+    trace_dir = _get_trace_dir()
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.json"
+    path = os.path.join(trace_dir, filename)
+    try:
+        os.makedirs(trace_dir, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+    except OSError:
+        logger.exception("trace 文件写入失败")
+        return
+    logger.info("已录制对话 trace: %s", path)
+
+
+def current_trace() -> TurnTrace | None:
+    """返回当前上下文中的 trace，未录制/回放时为 None."""
+    return _current_trace.get()
+
+
+def is_replaying() -> bool:
+    """当前是否处于回放中."""
+    trace = current_trace()
+    return trace is not None and trace.replaying
+
+
+def use_trace(trace: TurnTrace | None):
+    """设置当前上下文的 trace，返回用于 ``reset_trace`` 的 token."""
+    return _current_trace.set(trace)
+
+
+def reset_trace(token) -> None:
+    """恢复 ``use_trace`` 之前的 trace."""
+    try:
+        _current_trace.reset(token)
+    except ValueError:
+        # 在不同的上下文中结束（如生成器被其他任务关闭），直接清空
+        _current_trace.set(None)
+
+
+def begin_turn(
+    user_message: str,
+    history: list[dict] | None,
+    employee_id: str | None,
+) -> TurnTrace | None:
+    """开始一轮对话.
+
+    回放中返回回放用的 trace；录制模式下创建新 trace；否则返回 None。
+    """
+    trace = current_trace()
+    if trace is not None:
+        return trace
+    if _get_trace_mode() != "record":
+        return None
+
+    trace = TurnTrace()
+    trace.data["inputs"] = {
+        "user_message": user_message,
+        "history": history or [],
+        "employee_id": employee_id,
+    }
+    return trace
+
+
+def end_turn(trace: TurnTrace) -> None:
+    """结束一轮对话，录制模式下写入 trace 文件.
+
+    序列化在事件循环中完成，文件写入放到线程中执行，避免阻塞其他请求。
+    """
+    if trace.replaying:
+        return
+    content = trace.serialize()
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _write_trace(content)
+        return
+    task = loop.create_task(asyncio.to_thread(_write_trace, content))
+    _pending_writes.add(task)
+    task.add_done_callback(_pending_writes.discard)
+
+
+async def create_completion(client, **kwargs):
+    """流式 completion 请求入口，录制/回放时经由当前 trace."""
+    trace = current_trace()
+    if trace is None:
+        return await client.chat.completions.create(**kwargs)
+    return await trace.open_llm_stream(client, **kwargs)
+
+
+def select_model(select, *args) -> str | None:
+    """模型选择入口，录制/回放时经由当前 trace."""
+    trace = current_trace()
+    if trace is None:
+        return select(*args)
+    return trace.select_model(select, *args)
+
+
+def record_skill_call(name: str, arguments: str, result: str) -> None:
+    """记录一次 skill 调用."""
+    trace = current_trace()
+    if trace is not None:
+        trace.skill_calls.append(
+            {"name": name, "arguments": arguments, "result": result}
+        )
+
+
+def traced_oa_call(response_model):
+    """OA 接口方法装饰器，录制/回放时经由当前 trace.
+
+    回放时直接返回录制的响应，不执行被装饰的方法。
+    response_model 为接口返回的 pydantic 模型，用于回放时重建响应。
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            trace = current_trace()
+            if trace is None:
+                return await func(*args, **kwargs)
+            return await trace.call_oa(func.__name__, response_model, func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
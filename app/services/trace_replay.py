@@ -0,0 +1,240 @@
+"""对话回放 - 基于录制的 trace 无网络重放对话，用于性能回归测试.
+
+LLM chunk 流与 OA 响应从 trace 中读取，按原始节奏（或加速）回放，
+chat_stream 与 execute_skill 的自身逻辑照常执行（OAClient 方法整体使用录制的
+响应），从而得到可复现的 CPU 与延迟数据。每轮回放可挂载 cProfile 或采样 profiler。
+
+用法:
+    python -m app.services.trace_replay traces/ --speed 0 --profile cprofile --profile-dir prof/
+"""
+
+import argparse
+import asyncio
+import cProfile
+import json
+import os
+import sys
+import time
+from collections.abc import Callable
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+
+from app.services.chat_service import chat_stream
+from app.services.trace_recorder import TRACE_VERSION, TurnTrace, reset_trace, use_trace
+
+# 接收回放名称，返回包裹单轮回放的上下文管理器
+ProfileHook = Callable[[str], AbstractContextManager]
+
+
+# trace 文件必须包含的字段
+_REQUIRED_KEYS = ("inputs", "llm_calls", "skill_calls", "oa_calls", "events")
+
+
+class UnsupportedTraceVersion(ValueError):
+    """trace 文件版本与当前录制格式不一致."""
+
+
+class ReplayResult:
+    """单个 trace 的回放结果."""
+
+    def __init__(self, path: str, trace: TurnTrace, wall_time: float, cpu_time: float):
+        self.path = path
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.recorded_elapsed = trace.data.get("elapsed", 0.0)
+        self.events_match = trace.events == trace.data["events"]
+        self.skills_match = trace.skill_calls == trace.data["skill_calls"]
+        self.mismatches = trace.mismatches
+
+    @property
+    def diverged(self) -> bool:
+        """回放的请求或输出是否与录制结果不一致."""
+        return bool(self.mismatches) or not (self.events_match and self.skills_match)
+
+
+class ReplayError:
+    """未能回放的 trace；skipped 表示版本不兼容而跳过，否则为读取或回放失败."""
+
+    def __init__(self, path: str, message: str, skipped: bool = False):
+        self.path = path
+        self.message = message
+        self.skipped = skipped
+
+
+def load_trace(path: str) -> dict:
+    """读取 trace 文件.
+
+    版本不一致时抛出 UnsupportedTraceVersion，格式错误时抛出 ValueError。
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("trace 格式错误")
+    if data.get("version") != TRACE_VERSION:
+        raise UnsupportedTraceVersion(
+            f"不支持的 trace 版本: {data.get('version')}（当前为 {TRACE_VERSION}）"
+        )
+    missing = [key for key in _REQUIRED_KEYS if key not in data]
+    if missing:
+        raise ValueError(f"trace 缺少字段: {', '.join(missing)}")
+    return data
+
+
+def cprofile_hook(output_dir: str) -> ProfileHook:
+    """每轮回放使用 cProfile，结果写入 ``{output_dir}/{name}.prof``."""
+    os.makedirs(output_dir, exist_ok=True)
+
+    @contextmanager
+    def hook(name: str):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(output_dir, f"{name}.prof"))
+
+    return hook
+
+
+def pyinstrument_hook(output_dir: str, interval: float = 0.001) -> ProfileHook:
+    """每轮回放使用 pyinstrument 采样，结果写入 ``{output_dir}/{name}.html``.
+
+    pyinstrument 为可选依赖，需单独安装。
+    """
+    try:
+        from pyinstrument import Profiler
+    except ImportError as e:
+        raise RuntimeError("采样 profiler 需要先安装 pyinstrument: pip install pyinstrument") from e
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    @contextmanager
+    def hook(name: str):
+        profiler = Profiler(interval=interval)
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(os.path.join(output_dir, f"{name}.html"), "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+
+    return hook
+
+
+async def replay_turn(
+    path: str,
+    speed: float = 1.0,
+    profile_hook: ProfileHook | None = None,
+) -> ReplayResult:
+    """回放单个 trace 文件.
+
+    speed 为加速倍数：1 为原始节奏，0 表示不等待，仅测量自身代码开销。
+    """
+    data = load_trace(path)
+    trace = TurnTrace(data, speed=speed)
+    name = os.path.splitext(os.path.basename(path))[0]
+    inputs = data["inputs"]
+
+    token = use_trace(trace)
+    try:
+        with profile_hook(name) if profile_hook else nullcontext():
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            async for _ in chat_stream(
+                user_message=inputs["user_message"],
+                history=inputs["history"],
+                employee_id=inputs["employee_id"],
+            ):
+                pass
+            cpu_time = time.process_time() - cpu_start
+            wall_time = time.perf_counter() - wall_start
+    finally:
+        reset_trace(token)
+
+    return ReplayResult(path, trace, wall_time, cpu_time)
+
+
+def _collect_paths(paths: list[str]) -> list[str]:
+    """展开目录参数为其中的 trace 文件."""
+    collected = []
+    for path in paths:
+        if os.path.isdir(path):
+            collected.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith(".json")
+            )
+        else:
+            collected.append(path)
+    return collected
+
+
+async def _replay_all(
+    paths: list[str], speed: float, profile_hook: ProfileHook | None
+) -> list[ReplayResult | ReplayError]:
+    # 逐个回放，避免多轮交叠影响单轮的 CPU/延迟数据；单个文件出错不影响其余文件
+    results: list[ReplayResult | ReplayError] = []
+    for path in paths:
+        try:
+            results.append(await replay_turn(path, speed, profile_hook))
+        except UnsupportedTraceVersion as e:
+            results.append(ReplayError(path, str(e), skipped=True))
+        except (OSError, ValueError, KeyError) as e:
+            results.append(ReplayError(path, f"{type(e).__name__}: {e!s}"))
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="回放录制的对话 trace")
+    parser.add_argument("paths", nargs="+", help="trace 文件或目录")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="回放加速倍数，0 表示不等待（默认 1）"
+    )
+    parser.add_argument(
+        "--profile", choices=["cprofile", "pyinstrument"], help="每轮回放挂载的 profiler"
+    )
+    parser.add_argument("--profile-dir", default="profiles", help="profiler 输出目录")
+    args = parser.parse_args(argv)
+
+    paths = _collect_paths(args.paths)
+    if not paths:
+        parser.error("未找到 trace 文件")
+
+    profile_hook = None
+    if args.profile == "cprofile":
+        profile_hook = cprofile_hook(args.profile_dir)
+    elif args.profile == "pyinstrument":
+        profile_hook = pyinstrument_hook(args.profile_dir)
+
+    results = asyncio.run(_replay_all(paths, args.speed, profile_hook))
+
+    replayed = [r for r in results if isinstance(r, ReplayResult)]
+    errors = [r for r in results if isinstance(r, ReplayError)]
+    failed = [r for r in errors if not r.skipped]
+
+    print(f"{'trace':<40} {'录制(s)':>10} {'回放(s)':>10} {'CPU(s)':>10}  结果")
+    for r in results:
+        name = os.path.basename(r.path)
+        if isinstance(r, ReplayError):
+            status = "SKIPPED" if r.skipped else "FAILED"
+            print(f"{name:<40} {'-':>10} {'-':>10} {'-':>10}  {status}")
+            print(f"    {r.message}")
+            continue
+        status = "DIVERGED" if r.diverged else "ok"
+        print(
+            f"{name:<40} {r.recorded_elapsed:>10.3f} "
+            f"{r.wall_time:>10.3f} {r.cpu_time:>10.4f}  {status}"
+        )
+        for mismatch in r.mismatches:
+            print(f"    {mismatch}")
+    print(
+        f"共 {len(replayed)} 轮，CPU 合计 {sum(r.cpu_time for r in replayed):.4f}s，"
+        f"不一致 {sum(r.diverged for r in replayed)} 轮，"
+        f"跳过 {len(errors) - len(failed)} 个，失败 {len(failed)} 个"
+    )
+    return 1 if failed or any(r.diverged for r in replayed) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
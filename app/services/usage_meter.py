@@ -0,0 +1,386 @@
+"""Token 用量计量服务 - 按员工和 skill 路径聚合，支持每日预算.
+
+每轮对话最多发起两次 LLM 请求，优先使用服务商在流式响应末尾返回的 usage
+（``stream_options={"include_usage": True}``），缺失时使用本地估算。
+用量在内存中按天聚合，并由后台任务定期追加写入 JSON Lines 文件。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import date
+
+from app.models.schemas import EmployeeUsage, UsageReportResponse, UsageStats
+
+logger = logging.getLogger(__name__)
+
+# 未提供员工编号时的聚合键：所有匿名请求共用一个计数和预算
+ANONYMOUS_EMPLOYEE = "anonymous"
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的 token 数.
+
+    中日韩字符约 1 token/字，其余字符约 4 字符/token。
+    """
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if "\u3000" <= ch <= "\u9fff" or "\uff00" <= ch <= "\uffef")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_prompt_tokens(messages: list[dict], tools: list[dict] | None = None) -> int:
+    """估算请求消息（及 tools 定义）的 token 数."""
+    total = 0
+    for msg in messages:
+        # 每条消息的角色、分隔符等固定开销
+        total += 4
+        total += estimate_tokens(msg.get("content") or "")
+        for tc in msg.get("tool_calls") or []:
+            total += estimate_tokens(tc["function"]["name"])
+            total += estimate_tokens(tc["function"]["arguments"])
+    if tools:
+        total += estimate_tokens(json.dumps(tools, ensure_ascii=False))
+    return total
+
+
+class CallUsage:
+    """单次 LLM 流式请求的用量收集器."""
+
+    def __init__(self, messages: list[dict], tools: list[dict] | None = None):
+        # 浅拷贝消息列表：后续追加的 assistant/tool 消息不计入本次请求
+        self._messages = list(messages)
+        self._tools = tools
+        self._completion_parts: list[str] = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.reported = False
+
+    def observe(self, chunk) -> None:
+        """处理一个流式 chunk，记录服务商返回的 usage 或用于估算的输出文本."""
+        usage = getattr(chunk, "usage", None)
+        if usage:
+            self.prompt_tokens = usage.prompt_tokens or 0
+            self.completion_tokens = usage.completion_tokens or 0
+            self.reported = True
+            return
+
+        if self.reported or not chunk.choices:
+            return
+        delta = chunk.choices[0].delta
+        if not delta:
+            return
+        if delta.content:
+            self._completion_parts.append(delta.content)
+        for tc in delta.tool_calls or []:
+            if tc.function:
+                if tc.function.name:
+                    self._completion_parts.append(tc.function.name)
+                if tc.function.arguments:
+                    self._completion_parts.append(tc.function.arguments)
+
+    def finish(self) -> None:
+        """结束本次请求；服务商未返回 usage 时使用本地估算."""
+        if self.reported:
+            return
+        self.prompt_tokens = estimate_prompt_tokens(self._messages, self._tools)
+        self.completion_tokens = estimate_tokens("".join(self._completion_parts))
+
+
+class TurnUsage:
+    """一轮对话（可能包含多次 LLM 请求）的用量."""
+
+    def __init__(self, employee_id: str | None = None):
+        self.employee_id = employee_id
+        self.calls: list[CallUsage] = []
+        self.skills: list[str] = []
+        # 本轮在预算中预占、尚未结算的 token 数
+        self.reserved = 0
+
+    def start_call(self, messages: list[dict], tools: list[dict] | None = None) -> CallUsage:
+        """登记一次新的 LLM 请求."""
+        call = CallUsage(messages, tools)
+        self.calls.append(call)
+        return call
+
+    @property
+    def skill_path(self) -> str:
+        """本轮调用的 skill 路径，如 ``query_leave_balance+submit_leave_request``."""
+        return "+".join(self.skills) if self.skills else "chat"
+
+
+def _add_turn(stats: UsageStats, turn: TurnUsage) -> None:
+    stats.requests += 1
+    for call in turn.calls:
+        stats.llm_calls += 1
+        stats.prompt_tokens += call.prompt_tokens
+        stats.completion_tokens += call.completion_tokens
+        stats.total_tokens += call.prompt_tokens + call.completion_tokens
+        if not call.reported:
+            stats.estimated_calls += 1
+
+
+def _env_number(name: str, default, cast):
+    """读取数值型环境变量，无效时记录警告并使用默认值."""
+    raw = os.getenv(name, "")
+    if not raw:
+        return default
+    try:
+        return cast(raw)
+    except ValueError:
+        logger.warning("忽略无效的配置 %s=%s，使用默认值 %s", name, raw, default)
+        return default
+
+
+def _parse_overrides(raw: str) -> dict[str, int]:
+    """解析 ``EMP001=200000,EMP002=50000`` 格式的预算配置."""
+    overrides = {}
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        employee_id, _, value = item.partition("=")
+        try:
+            overrides[employee_id.strip()] = int(value)
+        except ValueError:
+            logger.warning("忽略无效的预算配置: %s", item)
+    return overrides
+
+
+class UsageMeter:
+    """Token 用量聚合与每日预算控制.
+
+    预算配置:
+        - daily_budget: 每人每日 token 上限，0 表示不限制
+        - budget_overrides: 按员工编号单独配置的上限
+        - anonymous_budget: 未提供员工编号的请求共用的每日上限，0 表示不限制
+        - fallback_model: 超出预算后改用的低成本模型，为空则拒绝请求
+    """
+
+    def __init__(
+        self,
+        daily_budget: int = 0,
+        budget_overrides: dict[str, int] | None = None,
+        anonymous_budget: int = 0,
+        fallback_model: str = "",
+        flush_path: str = "",
+        flush_interval: float = 60.0,
+    ):
+        self.daily_budget = daily_budget
+        self.budget_overrides = budget_overrides or {}
+        self.anonymous_budget = anonymous_budget
+        self.fallback_model = fallback_model
+        self.flush_path = flush_path
+        self.flush_interval = flush_interval
+
+        self._day = date.today()
+        self._total = UsageStats()
+        self._by_employee: dict[str, UsageStats] = {}
+        self._by_skill_path: dict[str, UsageStats] = {}
+        # 进行中对话预占的 token 数（按员工）
+        self._in_flight: dict[str, int] = {}
+        self._dirty = False
+        # 跨天落盘等后台写入任务，持有引用避免被回收
+        self._pending_writes: set[asyncio.Task] = set()
+
+    @classmethod
+    def from_env(cls) -> "UsageMeter":
+        """从环境变量读取配置."""
+        return cls(
+            daily_budget=_env_number("USAGE_DAILY_TOKEN_BUDGET", 0, int),
+            budget_overrides=_parse_overrides(os.getenv("USAGE_BUDGET_OVERRIDES", "")),
+            anonymous_budget=_env_number("USAGE_ANONYMOUS_TOKEN_BUDGET", 0, int),
+            fallback_model=os.getenv("USAGE_FALLBACK_MODEL", ""),
+            flush_path=os.getenv("USAGE_FLUSH_PATH", ""),
+            flush_interval=_env_number("USAGE_FLUSH_INTERVAL", 60.0, float),
+        )
+
+    # ==================== 预算 ====================
+
+    def budget_for(self, employee_id: str | None) -> int | None:
+        """返回员工的每日 token 上限，None 表示不限制.
+
+        匿名请求不使用每人上限，而是共用 anonymous_budget。
+        """
+        if employee_id and employee_id != ANONYMOUS_EMPLOYEE:
+            budget = self.budget_overrides.get(employee_id, self.daily_budget)
+        else:
+            budget = self.anonymous_budget
+        return budget if budget > 0 else None
+
+    def used_today(self, employee_id: str | None) -> int:
+        """返回员工今日已使用的 token 数，含进行中对话的预占."""
+        self._roll_day()
+        return self._used(employee_id or ANONYMOUS_EMPLOYEE)
+
+    def _used(self, key: str) -> int:
+        stats = self._by_employee.get(key)
+        return (stats.total_tokens if stats else 0) + self._in_flight.get(key, 0)
+
+    def select_model(self, employee_id: str | None, model: str) -> str | None:
+        """根据预算选择本轮使用的模型.
+
+        未超出预算时返回原模型；超出时返回 fallback 模型，未配置则返回 None。
+        """
+        budget = self.budget_for(employee_id)
+        if budget is None or self.used_today(employee_id) < budget:
+            return model
+        return self.fallback_model or None
+
+    def select_followup_model(self, turn: TurnUsage, model: str) -> str:
+        """选择 tool 调用之后的后续请求所用的模型.
+
+        此时 skill 已执行（可能已提交请假），不再拒绝，仅在超出预算时改用
+        fallback 模型；本轮自身的预占不计入已用量。
+        """
+        budget = self.budget_for(turn.employee_id)
+        if budget is None or not self.fallback_model:
+            return model
+        if self.used_today(turn.employee_id) - turn.reserved < budget:
+            return model
+        return self.fallback_model
+
+    def reserve(self, turn: TurnUsage, messages: list[dict], tools: list[dict] | None = None) -> None:
+        """在发起 LLM 请求前按估算的输入 token 预占预算.
+
+        用量在一轮结束时才结算，预占使并发进行中的对话同样受预算约束。
+        """
+        if self.budget_for(turn.employee_id) is None:
+            return
+        tokens = estimate_prompt_tokens(messages, tools)
+        key = turn.employee_id or ANONYMOUS_EMPLOYEE
+        turn.reserved += tokens
+        self._in_flight[key] = self._in_flight.get(key, 0) + tokens
+
+    def _release(self, turn: TurnUsage) -> None:
+        if not turn.reserved:
+            return
+        key = turn.employee_id or ANONYMOUS_EMPLOYEE
+        remaining = self._in_flight.get(key, 0) - turn.reserved
+        if remaining > 0:
+            self._in_flight[key] = remaining
+        else:
+            self._in_flight.pop(key, None)
+        turn.reserved = 0
+
+    # ==================== 聚合 ====================
+
+    def record_turn(self, turn: TurnUsage) -> None:
+        """结算一轮对话的用量，并释放其预占."""
+        self._release(turn)
+        if not turn.calls:
+            return
+        for call in turn.calls:
+            call.finish()
+
+        self._roll_day()
+        key = turn.employee_id or ANONYMOUS_EMPLOYEE
+        _add_turn(self._total, turn)
+        _add_turn(self._by_employee.setdefault(key, UsageStats()), turn)
+        _add_turn(self._by_skill_path.setdefault(turn.skill_path, UsageStats()), turn)
+        self._dirty = True
+
+    def report(self, employee_id: str | None = None) -> UsageReportResponse:
+        """生成当日用量报告.
+
+        employee_id 只过滤 employees 列表，即使该员工今日尚无用量也会返回其
+        预算信息；total 与 skill_paths 始终为全公司汇总。
+        """
+        self._roll_day()
+        return self._build_report(employee_id)
+
+    def _build_report(self, employee_id: str | None = None) -> UsageReportResponse:
+        if employee_id:
+            items = [(employee_id, self._by_employee.get(employee_id) or UsageStats())]
+        else:
+            items = sorted(self._by_employee.items())
+
+        employees = []
+        for key, stats in items:
+            budget = self.budget_for(key)
+            # 与预算判断一致，计入进行中对话的预占
+            used = self._used(key)
+            employees.append(
+                EmployeeUsage(
+                    employee_id=key,
+                    usage=stats,
+                    daily_budget=budget,
+                    remaining_tokens=max(budget - used, 0) if budget else None,
+                    over_budget=budget is not None and used >= budget,
+                )
+            )
+        return UsageReportResponse(
+            date=self._day.isoformat(),
+            total=self._total,
+            employees=employees,
+            skill_paths=self._by_skill_path,
+        )
+
+    def _roll_day(self) -> None:
+        """跨天时重置计数，并在后台落盘前一天的数据."""
+        today = date.today()
+        if today == self._day:
+            return
+        line = self._snapshot_line() if self.flush_path and self._dirty else None
+        self._day = today
+        self._total = UsageStats()
+        self._by_employee = {}
+        self._by_skill_path = {}
+        self._dirty = False
+        if line:
+            self._write_in_background(line)
+
+    # ==================== 落盘 ====================
+
+    def _snapshot_line(self) -> str:
+        snapshot = self._build_report().model_dump()
+        snapshot["flushed_at"] = time.time()
+        return json.dumps(snapshot, ensure_ascii=False) + "\n"
+
+    def _write(self, line: str) -> bool:
+        """追加写入一行快照，失败时记录日志并返回 False."""
+        try:
+            with open(self.flush_path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError:
+            logger.exception("用量数据落盘失败")
+            return False
+        return True
+
+    def _write_in_background(self, line: str) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(line)
+            return
+        task = loop.create_task(asyncio.to_thread(self._write, line))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._pending_writes.discard)
+
+    def flush(self) -> None:
+        """将当日聚合快照追加写入文件（仅在有新数据时）.
+
+        同步写入，仅用于进程退出等不在请求路径上的场合。
+        """
+        if not self.flush_path or not self._dirty:
+            return
+        if self._write(self._snapshot_line()):
+            self._dirty = False
+
+    async def run_periodic_flush(self) -> None:
+        """后台定期落盘任务."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if not self.flush_path or not self._dirty:
+                continue
+            # 在事件循环中生成快照，文件写入放到线程中执行
+            line = self._snapshot_line()
+            self._dirty = False
+            if not await asyncio.to_thread(self._write, line):
+                self._dirty = True
+
+
+# 全局单例
+usage_meter = UsageMeter.from_env()